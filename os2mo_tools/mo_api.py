@@ -7,56 +7,181 @@
 #
 """A simple API for requesting data from MO."""
 import logging
-from collections import defaultdict
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
 
 import requests
-from cached_property import cached_property
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+# Connection pool sizing for the shared session. Every request to MO goes
+# through the same pool, so keep-alive connections are reused across the
+# whole crawl instead of paying a new TCP/TLS handshake per call.
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 64
+# Upper bound on concurrent requests issued by a single fan-out, to avoid
+# tripping rate limits on the MO server.
+MAX_WORKERS = 16
+# Paging of list endpoints: items per page and number of pages kept in
+# flight while the caller consumes the current one.
+PAGE_SIZE = 1000
+PREFETCH = 4
+
+# Marks the threads of a Connector's worker pool, see Connector._map.
+_pool_thread = threading.local()
+
+
+def _detail_property(name):
+    """Property fetching the detail ``name`` once and storing it."""
+
+    def getter(self):
+        stored = self._stored_details
+        try:
+            return stored[name]
+        except KeyError:
+            stored[name] = detail = self._get_detail(name)
+            return detail
+
+    return property(getter, doc=f"The {name} details of the object.")
+
 
 class MOData:
     """Abstract base class to interface with MO objects."""
 
+    # Many instances are created while crawling, so avoid a per-instance
+    # dict. ``url`` and ``_details_url`` are set by the subclasses.
+    __slots__ = (
+        "uuid",
+        "connector",
+        "validity",
+        "url",
+        "_details_url",
+        "_stored_details",
+        "_json",
+        "_children",
+        "_details_listing",
+    )
+
+    # Details which may be requested for objects of this type.
+    _DETAIL_NAMES = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        """Add a property for each detail in ``_DETAIL_NAMES``."""
+        super().__init_subclass__(**kwargs)
+        for name in cls.__dict__.get("_DETAIL_NAMES", ()):
+            setattr(cls, name, _detail_property(name))
+
     def __init__(self, uuid, connector, validity):
         """Initialize object from ``uuid``."""
         self.uuid = uuid
         self.connector = connector
         self.validity = validity
-        self._stored_details = defaultdict(list)
-
-    @cached_property
+        self._stored_details = {}
+        self._json = None
+        self._children = None
+        self._details_listing = None
+
+    @classmethod
+    def from_bulk(cls, records, connector, validity="present"):
+        """Construct objects from ``{uuid: {detail: content}}`` records.
+
+        The details are stored on the objects, so accessing them does not
+        cause further requests to MO. The contents are shared with
+        ``records``, not copied.
+        """
+        objects = []
+        for uuid, details in records.items():
+            obj = cls(uuid, connector, validity)
+            obj._stored_details.update(details)
+            objects.append(obj)
+        return objects
+
+    @property
     def json(self):
         """JSON representation of the object itself (no details)."""
-        return self.connector.mo_get(self.url)
+        if self._json is None:
+            self._json = self.connector.mo_get(self.url)
+        return self._json
 
-    @cached_property
+    @property
     def children(self):
         """Children of the current object.
 
         Will currently only work with Org Units.
         """
-        return self.connector.mo_get(self.url + "children/")
+        if self._children is None:
+            self._children = self.connector.mo_get(f"{self.url}children/")
+        return self._children
 
-    @cached_property
+    @property
     def _details(self):
-        return self.connector.mo_get(self.url + "details/")
+        if self._details_listing is None:
+            self._details_listing = self.connector.mo_get(self._details_url)
+        return self._details_listing
+
+    def refresh(self):
+        """Forget fetched data, so it is requested again on next access.
+
+        If the connector has a response cache, call
+        :meth:`Connector.clear_cache` as well to get fresh data from MO.
+        """
+        self._json = None
+        self._children = None
+        self._details_listing = None
+        self._stored_details = {}
+
+    def list_details(self):
+        """Which details are available, and whether they have content."""
+        return self._details
 
     def _get_detail(self, detail):
-        return self.connector.mo_get(self.url + "details/" + detail, validity=self.validity)
+        return self.connector.mo_get(
+            self._details_url + detail, validity=self.validity
+        )
+
+    def fetch_all_details(self):
+        """Fetch all populated details concurrently.
+
+        Returns a dict mapping each available detail name to its content.
+        """
+        names = [
+            name
+            for name, present in self._details.items()
+            if present and name not in self._stored_details
+        ]
+        details = self.connector._map(self._get_detail, names)
+        for name, detail in zip(names, details):
+            self._stored_details[name] = detail
+        return {
+            name: self._stored_details.get(name, []) for name in self._details
+        }
 
     def __getattr__(self, name):
-        """Get details if field in details for object.
+        """Get details not listed in ``_DETAIL_NAMES``.
 
-        Available details for OrgFunc are: address, association,
-        engagement, it, leave, manager, org_unit, role
+        Details in ``_DETAIL_NAMES`` are properties on the class and do not
+        pass through here. Any other detail is looked up in the details
+        listing from MO and fetched if present there.
         """
-        if name in self._details:
-            if name not in self._stored_details and self._details[name]:
-                self._stored_details[name] = self._get_detail(name)
-            return self._stored_details[name]
-        else:
-            raise AttributeError("No such attribute: {}".format(name))
+        if name.startswith("_"):
+            # Private and dunder probes (copy, pickle, hasattr) never name a
+            # detail, and _stored_details may not be set yet.
+            raise AttributeError(name)
+        stored = self._stored_details
+        if name in stored:
+            return stored[name]
+        details = self._details
+        if name in details:
+            stored[name] = detail = (
+                self._get_detail(name) if details[name] else []
+            )
+            return detail
+        raise AttributeError(name)
 
     def __str__(self):
         """String representation - JSON representation without details."""
@@ -66,26 +191,104 @@ class MOData:
 class OrgUnit(MOData):
     """A MO organisation unit, e.g. a department in a municipality."""
 
+    __slots__ = ()
+
+    _DETAIL_NAMES = frozenset({
+        "address",
+        "association",
+        "engagement",
+        "it",
+        "leave",
+        "manager",
+        "org_unit",
+        "role",
+    })
+
     def __init__(self, uuid, connector, validity):
         """Initialize the org unit by specifying the URL prefix."""
         super().__init__(uuid, connector, validity)
-        self.url = connector.mo_url + "/ou/" + self.uuid + "/"
+        self.url = f"{connector.mo_url}/ou/{uuid}/"
+        self._details_url = f"{self.url}details/"
 
 
 class Employee(MOData):
     """A MO employee."""
 
+    __slots__ = ()
+
+    _DETAIL_NAMES = frozenset({
+        "address",
+        "association",
+        "engagement",
+        "it",
+        "leave",
+        "manager",
+        "role",
+    })
+
     def __init__(self, uuid, connector, validity):
         """Initialize the employee by specifying the URL prefix."""
         super().__init__(uuid, connector, validity)
-        self.url = connector.mo_url + "/e/" + self.uuid + "/"
+        self.url = f"{connector.mo_url}/e/{uuid}/"
+        self._details_url = f"{self.url}details/"
 
 
 class Connector:
-    def __init__(self, mo_url, org_uuid=None, api_token=None):
+    # Organisation discovered per MO URL, shared by all caching connectors
+    # in the process so constructing further ones costs no request.
+    _org_ids = {}
+
+    def __init__(
+        self,
+        mo_url,
+        org_uuid=None,
+        api_token=None,
+        cache_size=0,
+        session=None,
+        page_size=PAGE_SIZE,
+        prefetch=PREFETCH,
+        verify_tls=True,
+    ):
+        """Connect to MO at ``mo_url``.
+
+        ``cache_size`` enables memoizing up to that many responses, see
+        :meth:`mo_get`, and reusing the organisation discovered by other
+        caching connectors for the same ``mo_url``, see
+        :meth:`clear_org_cache`. It is off by default.
+
+        ``session`` may be any Requests-compatible session, e.g. one that
+        speaks HTTP/2. By default a pooled :class:`requests.Session` is used.
+
+        While iterating over :meth:`get_ous` or :meth:`get_employees`, the
+        page being consumed and up to ``prefetch`` pages fetched ahead are
+        held in memory, i.e. at most ``(prefetch + 1) * page_size`` items;
+        ``prefetch=0`` fetches the pages one at a time.
+
+        Pass ``verify_tls=False`` to skip certificate verification, e.g. for
+        test instances with self-signed certificates.
+        """
+        if page_size <= 0:
+            raise ValueError("page_size must be positive")
+        if prefetch < 0:
+            raise ValueError("prefetch must not be negative")
         self.mo_url = mo_url
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
         self.api_token = api_token
-        self.session = requests.Session()
+        self._owns_session = session is None
+        if session is None:
+            session = self._make_session()
+        self.session = session
+        # Passed on every request: a session-level verify is overridden by
+        # REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE from the environment.
+        self._verify = verify_tls
+        if not verify_tls:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         if api_token:
             self.session.headers["session"] = api_token
 
@@ -94,62 +297,232 @@ class Connector:
         else:
             self.org_id = self._get_org()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the worker pool, and the session if we created it."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        if self._owns_session:
+            self.session.close()
+
+    def _mark_pool_thread(self):
+        _pool_thread.connector = self
+
+    def _map(self, func, items):
+        """Map ``func`` over ``items`` on the connector's worker pool.
+
+        On one of the pool's own threads the calls run inline instead, as
+        waiting on the pool from inside it can deadlock.
+        """
+        if getattr(_pool_thread, "connector", None) is self:
+            return map(func, items)
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS,
+                    initializer=self._mark_pool_thread,
+                )
+            executor = self._executor
+        return executor.map(func, items)
+
+    @staticmethod
+    def _make_session():
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            # Hand the last 5xx response back once retries run out, so it
+            # is reported through raise_for_status as an HTTPError.
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     def mo_get(self, url, **params):
         """Helper function for getting data from MO.
 
         Return JSON content if successful, throw exception if not.
+
+        If the connector has a ``cache_size``, responses are memoized per
+        URL and parameters, keeping the ``cache_size`` most recently used.
+        Cached results are not refreshed until :meth:`clear_cache` is
+        called, and the same object is returned to every caller, so it
+        must not be mutated.
         """
-        result = self.session.get(url, verify=False, params=params)
-        if not result:
-            result.raise_for_status()
-        else:
+        if not self.cache_size:
+            return self._do_get(url, **params)
+        key = (url, tuple(sorted(params.items())))
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        value = self._do_get(url, **params)
+        with self._cache_lock:
+            self._cache[key] = value
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def clear_cache(self):
+        """Forget all memoized responses."""
+        with self._cache_lock:
+            self._cache.clear()
+
+    @classmethod
+    def clear_org_cache(cls):
+        """Forget the organisations discovered by caching connectors."""
+        cls._org_ids.clear()
+
+    def _do_get(self, url, **params):
+        result = self.session.get(url, params=params, verify=self._verify)
+        # Same test as Response.ok, without going through raise_for_status.
+        if result.status_code < 400:
             return result.json()
+        result.raise_for_status()
 
     def _get_org(self):
-        organisations = self.mo_get(self.mo_url + "/o/")
+        if self.cache_size and self.mo_url in Connector._org_ids:
+            return Connector._org_ids[self.mo_url]
+        organisations = self.mo_get(f"{self.mo_url}/o/")
         if organisations:
             if len(organisations) > 1:
                 logger.warning(
                     "More than one organisation exists in LoRa. Using first one found"
                 )
-            return organisations[0]["uuid"]
+            org_id = organisations[0]["uuid"]
+            if self.cache_size:
+                Connector._org_ids[self.mo_url] = org_id
+            return org_id
 
         raise Exception('No organisation found in LoRa')
 
+    def _get_paged(self, url, **params):
+        """Yield all items from a paged MO endpoint.
+
+        The first page also carries the total, so the remaining page
+        offsets are known once it arrives; up to ``prefetch`` of them are
+        fetched ahead while the caller consumes the current page. Pages
+        bypass the response cache, so they are released once consumed.
+        """
+        first = self._do_get(url, limit=self.page_size, start=0, **params)
+        starts = range(self.page_size, first["total"], self.page_size)
+        if not self.prefetch:
+            yield from first["items"]
+            del first
+            for start in starts:
+                yield from self._do_get(
+                    url, limit=self.page_size, start=start, **params
+                )["items"]
+            return
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            pages = (
+                executor.submit(
+                    self._do_get, url, limit=self.page_size, start=start, **params
+                )
+                for start in starts
+            )
+            pending = deque(islice(pages, self.prefetch))
+            yield from first["items"]
+            del first
+            while pending:
+                page = pending.popleft().result()
+                pending.extend(islice(pages, 1))
+                yield from page["items"]
+
     def get_ous(self, root=None):
         """Get all organization units belonging to org_id."""
-        ou_url = self.mo_url + "/o/" + self.org_id + "/ou/"
-        limit_1_url = ou_url+ "?limit=1"
+        ou_url = f"{self.mo_url}/o/{self.org_id}/ou/"
         if root:
-            limit_1_url += f"&root={str(root)}"
-        total_ous = self.mo_get("{}".format(limit_1_url))["total"]
-        offset = 1000
-        start = 0
-
-        while start < total_ous:
-            ou_url = "{}?limit={}&start={}".format(ou_url, offset, start)
-            if root:
-                ou_url += f"&root={str(root)}"
-            yield from self.mo_get(
-                ou_url
-            )["items"]
-            start += offset
+            return self._get_paged(ou_url, root=str(root))
+        return self._get_paged(ou_url)
+
+    def get_ous_with_details(
+        self, detail_types=OrgUnit._DETAIL_NAMES, root=None, validity="present"
+    ):
+        """Get the given details for all organisation units.
+
+        Each unit's details listing is read first, and only the details it
+        marks as populated are requested; empty ones are stored as ``[]``.
+        Units are processed concurrently, with at most ``2 * MAX_WORKERS``
+        queued at a time. Returns a dict ``{uuid: {detail: content}}``
+        which can be passed on to :meth:`OrgUnit.from_bulk`.
+        """
+        def fetch(uuid):
+            ou = OrgUnit(uuid, self, validity)
+            listing = ou._details
+            return uuid, {
+                detail: ou._get_detail(detail) if listing.get(detail) else []
+                for detail in detail_types
+            }
+
+        result = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pending = deque()
+            for ou in self.get_ous(root):
+                pending.append(executor.submit(fetch, ou["uuid"]))
+                if len(pending) >= 2 * MAX_WORKERS:
+                    uuid, details = pending.popleft().result()
+                    result[uuid] = details
+            while pending:
+                uuid, details = pending.popleft().result()
+                result[uuid] = details
+        return result
+
+    def walk_ous(self, root_uuid, max_in_flight=MAX_WORKERS, validity="present"):
+        """Yield the org unit ``root_uuid`` and all units below it.
+
+        The children of up to ``max_in_flight`` units are fetched
+        concurrently, so the tree is traversed in about one round-trip per
+        level rather than one per unit. Units are yielded as they arrive.
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive")
+        return self._walk_ous(root_uuid, max_in_flight, validity)
+
+    def _walk_ous(self, root_uuid, max_in_flight, validity):
+        def visit(uuid):
+            ou = OrgUnit(uuid, self, validity)
+            ou.children  # Fetch in the worker thread.
+            return ou
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            pending = {executor.submit(visit, root_uuid)}
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ou = future.result()
+                        pending.update(
+                            executor.submit(visit, child["uuid"])
+                            for child in ou.children
+                        )
+                        yield ou
+            finally:
+                # Drop queued requests if the caller stops early or a fetch
+                # fails, so leaving the pool only waits for running ones.
+                for future in pending:
+                    future.cancel()
 
     def get_ou_connector(self, org_unit_uuid, validity='present'):
         return OrgUnit(org_unit_uuid, self, validity)
 
     def get_employees(self):
         """Get all employees belonging to the given organization."""
-        employee_url = self.mo_url + "/o/" + self.org_id + "/e/"
-        total_employees = self.mo_get("{}?limit=1".format(employee_url))["total"]
-        offset = 1000
-        start = 0
-
-        while start < total_employees:
-            yield from self.mo_get(
-                "{}?limit={}&start={}".format(employee_url, offset, start)
-            )["items"]
-            start += offset
+        employee_url = f"{self.mo_url}/o/{self.org_id}/e/"
+        return self._get_paged(employee_url)
 
     def get_employee_connector(self, employee_uuid, validity='present'):
         return Employee(employee_uuid, self, validity)
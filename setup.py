@@ -10,15 +10,17 @@ import setuptools
 
 setuptools.setup(
     name='os2mo_tools',
-    version='0.2.3',
+    version='0.3.0',
     description='Tools for communicating with OS2MO',
     author='Magenta ApS',
     author_email='info@magenta.dk',
     packages=setuptools.find_packages(),
     install_requires=[
-        'requests>=2.21.0',
-        'cached_property==1.5.1'
+        'requests>=2.26.0',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MPL 2.0",